@@ -0,0 +1,346 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import fitz
+import pytest
+from fastapi.testclient import TestClient
+
+# Force a worker pool even on single-CPU hosts so the parallel path is tested
+os.environ.setdefault("REDACTION_WORKERS", "3")
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+def make_pdf(page_count: int) -> fitz.Document:
+    pdf_doc = fitz.open()
+    for page_num in range(page_count):
+        page = pdf_doc.new_page()
+        page.insert_text((72, 72), f"SSN-{page_num}")
+        page.insert_text((72, 144), f"Public {page_num}")
+    return pdf_doc
+
+
+def ssn_items(client: TestClient, pdf_bytes: bytes, pages=None) -> list:
+    response = client.post("/extract-text-with-positions", files={"pdf_file": ("in.pdf", pdf_bytes)})
+    assert response.status_code == 200
+    return [
+        dict(block, type="ssn")
+        for block in response.json()["text_blocks"]
+        if block["text"].startswith("SSN") and (pages is None or block["page"] in pages)
+    ]
+
+
+def redact(client: TestClient, pdf_bytes: bytes, items: list) -> fitz.Document:
+    response = client.post(
+        "/redact-pdf",
+        files={"pdf_file": ("in.pdf", pdf_bytes)},
+        data={"redaction_items": json.dumps(items)},
+    )
+    assert response.status_code == 200, response.text
+    return fitz.open(stream=response.content, filetype="pdf")
+
+
+def test_existing_redact_annotations_are_applied(client):
+    pdf_doc = make_pdf(3)
+    page = pdf_doc[2]
+    page.add_redact_annot(page.search_for("SSN-2")[0])
+    pdf_bytes = pdf_doc.tobytes()
+
+    redacted = redact(client, pdf_bytes, ssn_items(client, pdf_bytes, pages={1}))
+
+    assert "SSN-0" not in redacted[0].get_text()
+    assert "SSN-2" not in redacted[2].get_text()
+    assert "Public 2" in redacted[2].get_text()
+    assert next(redacted[2].annots(types=[fitz.PDF_ANNOT_REDACT]), None) is None
+
+
+def make_structured_pdf(page_count: int, with_forms: bool) -> fitz.Document:
+    pdf_doc = make_pdf(page_count)
+    index_page = pdf_doc[0]
+    for page_num in range(page_count):
+        index_page.insert_link({
+            "kind": fitz.LINK_GOTO,
+            "from": fitz.Rect(300, 20 + 20 * page_num, 400, 35 + 20 * page_num),
+            "page": page_num,
+        })
+        page = pdf_doc[page_num]
+        page.insert_link({"kind": fitz.LINK_URI, "from": fitz.Rect(300, 500, 400, 520), "uri": "https://example.com"})
+        if with_forms:
+            widget = fitz.Widget()
+            widget.field_name = f"field_{page_num}"
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.rect = fitz.Rect(72, 600, 272, 620)
+            page.add_widget(widget)
+    pdf_doc.set_toc([[1, f"Page {page_num + 1}", page_num + 1] for page_num in range(page_count)])
+    return pdf_doc
+
+
+def describe(pdf_doc: fitz.Document) -> list:
+    return [
+        (
+            page.get_label(),
+            page.get_text(),
+            sorted((link["kind"], link.get("page", -1), link.get("uri", "")) for link in page.get_links()),
+            sorted(widget.field_name for widget in page.widgets()),
+        )
+        for page in pdf_doc
+    ]
+
+
+@pytest.mark.parametrize("with_links, with_forms", [(False, False), (True, False), (True, True)])
+def test_parallel_redaction_matches_serial(client, monkeypatch, with_links, with_forms):
+    if with_links:
+        pdf_doc = make_structured_pdf(12, with_forms)
+    else:
+        pdf_doc = make_pdf(12)
+        pdf_doc.set_toc([[1, f"Page {page_num + 1}", page_num + 1] for page_num in range(12)])
+    pdf_doc.set_page_labels([
+        {"startpage": 0, "prefix": "A-", "style": "D", "firstpagenum": 1},
+        {"startpage": 6, "prefix": "", "style": "r", "firstpagenum": 1},
+    ])
+    pdf_bytes = pdf_doc.tobytes()
+    items = ssn_items(client, pdf_bytes)
+
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 10_000)
+    serial = redact(client, pdf_bytes, items)
+
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", 3)
+    parallel = redact(client, pdf_bytes, items)
+
+    assert describe(parallel) == describe(serial)
+    assert parallel.get_toc() == serial.get_toc() == pdf_doc.get_toc()
+    assert [parallel[0].get_label(), parallel[6].get_label()] == ["A-1", "i"]
+    assert all("SSN" not in text for _, text, _, _ in describe(parallel))
+    if with_forms:
+        assert len(list(parallel[5].widgets())) == 1
+        assert len(parallel[0].get_links()) >= 12
+
+
+def test_single_worker_skips_pool(client, monkeypatch):
+    pdf_bytes = make_pdf(12).tobytes()
+    items = ssn_items(client, pdf_bytes)
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", 1)
+
+    def fail(*args):
+        raise AssertionError("worker pool used with a single page group")
+
+    monkeypatch.setattr(main, "redact_pages_worker", fail)
+    redacted = redact(client, pdf_bytes, items)
+
+    assert all("SSN" not in page.get_text() for page in redacted)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_large_upload_is_read_from_the_spool_file(client, monkeypatch, workers):
+    pdf_doc = make_pdf(12)
+    pdf_doc.embfile_add("padding", os.urandom(main.UPLOAD_SPOOL_MAX_SIZE + 1))
+    pdf_bytes = pdf_doc.tobytes()
+    assert len(pdf_bytes) > main.UPLOAD_SPOOL_MAX_SIZE
+    items = ssn_items(client, pdf_bytes)
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", workers)
+
+    sources = []
+    open_pdf = main.open_pdf
+    worker_pdf_source = main.worker_pdf_source
+
+    def recording_open_pdf(source):
+        sources.append(source)
+        return open_pdf(source)
+
+    def recording_worker_pdf_source(*args):
+        sources.append(worker_pdf_source(*args))
+        return sources[-1]
+
+    monkeypatch.setattr(main, "open_pdf", recording_open_pdf)
+    monkeypatch.setattr(main, "worker_pdf_source", recording_worker_pdf_source)
+    redacted = redact(client, pdf_bytes, items)
+
+    assert all("SSN" not in page.get_text() for page in redacted)
+    assert isinstance(sources[0], memoryview)
+    if workers > 1:
+        assert isinstance(sources[1], str)
+
+
+def crash_worker(*args):
+    os._exit(1)
+
+
+def test_warm_up_starts_every_worker():
+    pool = main.create_redaction_pool()
+    try:
+        asyncio.run(main.warm_up_pool(pool))
+        assert len(pool._processes) == main.REDACTION_WORKERS
+    finally:
+        pool.shutdown(wait=True)
+
+
+def test_job_that_breaks_the_pool_is_not_retried(client, monkeypatch):
+    pdf_bytes = make_pdf(12).tobytes()
+    items = ssn_items(client, pdf_bytes)
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", 3)
+    pool = main.app.state.pool
+    pools_created = []
+    create_redaction_pool = main.create_redaction_pool
+
+    def counting_create_redaction_pool():
+        pools_created.append(create_redaction_pool())
+        return pools_created[-1]
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "redact_pages_worker", crash_worker)
+        patch.setattr(main, "create_redaction_pool", counting_create_redaction_pool)
+        response = client.post(
+            "/redact-pdf",
+            files={"pdf_file": ("in.pdf", pdf_bytes)},
+            data={"redaction_items": json.dumps(items)},
+        )
+    assert response.status_code == 500
+    new_pool = main.app.state.pool
+    assert pools_created == [new_pool]
+    assert new_pool is not pool
+
+    redacted = redact(client, pdf_bytes, items)
+    assert all("SSN" not in page.get_text() for page in redacted)
+    assert main.app.state.pool is new_pool
+
+
+def test_broken_pool_is_replaced(client, monkeypatch):
+    pdf_bytes = make_pdf(12).tobytes()
+    items = ssn_items(client, pdf_bytes)
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", 3)
+    redact(client, pdf_bytes, items)
+
+    pool = main.app.state.pool
+    for process in list(pool._processes.values()):
+        process.kill()
+    deadline = time.monotonic() + 10
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert pool._broken
+
+    for _ in range(2):
+        redacted = redact(client, pdf_bytes, items)
+        assert all("SSN" not in page.get_text() for page in redacted)
+    assert main.app.state.pool is not pool
+
+
+def test_rotated_page_is_fully_redacted(client):
+    pdf_doc = fitz.open()
+    page = pdf_doc.new_page(width=612, height=792)
+    for point, text in [((72, 72), "TOP-SSN"), ((72, 400), "MID-SSN"), ((500, 760), "LOW-SSN")]:
+        page.insert_text(point, text)
+    page.set_rotation(90)
+    pdf_bytes = pdf_doc.tobytes()
+
+    response = client.post("/extract-text-with-positions", files={"pdf_file": ("in.pdf", pdf_bytes)})
+    redacted = redact(client, pdf_bytes, response.json()["text_blocks"])
+
+    assert redacted[0].get_text().strip() == ""
+
+
+def box_items(*boxes) -> list:
+    return [(x, y, width, height, "test") for x, y, width, height in boxes]
+
+
+def test_boxes_without_area_are_skipped():
+    page = fitz.open().new_page()
+    main.add_redactions(page, box_items((10, 10, 0, 20), (10, 10, 20, 0), (10, 10, -5, 20), (10, 10, 0.4, 20)))
+
+    # Only the thin but non-empty box can still cover a glyph
+    assert len(list(page.annots())) == 1
+
+
+def test_contained_boxes_are_merged():
+    page = fitz.open().new_page()
+    main.add_redactions(page, box_items((10, 10, 100, 50), (20, 20, 10, 10), (10, 10, 100, 50), (200, 200, 10, 10)))
+
+    assert len(list(page.annots())) == 2
+
+
+def test_contained_box_redacts_its_text(client):
+    pdf_bytes = make_pdf(1).tobytes()
+    items = ssn_items(client, pdf_bytes)
+    bbox = items[0]["bbox"]
+    outer = {"page": 1, "type": "ssn", "bbox": {
+        "x": bbox["x"] - 5, "y": bbox["y"] - 5, "width": bbox["width"] + 10, "height": bbox["height"] + 10,
+    }}
+
+    redacted = redact(client, pdf_bytes, items + [outer])
+
+    assert "SSN-0" not in redacted[0].get_text()
+    assert "Public 0" in redacted[0].get_text()
+
+
+def test_large_parallel_merge_swaps_pages_in_bulk(client, monkeypatch):
+    page_count = 300
+    pdf_doc = make_pdf(page_count)
+    pdf_doc.set_toc([[1, f"Page {page_num + 1}", page_num + 1] for page_num in range(page_count)])
+    pdf_bytes = pdf_doc.tobytes()
+    items = ssn_items(client, pdf_bytes)
+
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 10_000)
+    serial = redact(client, pdf_bytes, items)
+
+    # Swapping pages one at a time rescans the outline and links on every
+    # call; the merge must insert each worker's pages in one call instead
+    insert_calls = []
+    insert_pdf = fitz.Document.insert_pdf
+
+    def counting_insert_pdf(self, *args, **kwargs):
+        insert_calls.append(kwargs)
+        return insert_pdf(self, *args, **kwargs)
+
+    def fail_delete_page(self, *args, **kwargs):
+        raise AssertionError("pages deleted one at a time during merge")
+
+    monkeypatch.setattr(fitz.Document, "insert_pdf", counting_insert_pdf)
+    monkeypatch.setattr(fitz.Document, "delete_page", fail_delete_page)
+    monkeypatch.setattr(main, "PARALLEL_REDACTION_MIN_PAGES", 1)
+    monkeypatch.setattr(main, "REDACTION_WORKERS", 3)
+    start = time.perf_counter()
+    parallel = redact(client, pdf_bytes, items)
+    parallel_seconds = time.perf_counter() - start
+
+    assert len(insert_calls) == 3
+    assert describe(parallel) == describe(serial)
+    assert parallel.get_toc() == serial.get_toc()
+    # The per-page merge took several seconds here; the bulk one is well under
+    assert parallel_seconds < 5
+
+
+def test_errors_are_logged_with_traceback(client, caplog):
+    response = client.post(
+        "/redact-pdf",
+        files={"pdf_file": ("in.pdf", b"not a pdf")},
+        data={"redaction_items": "[]"},
+    )
+
+    assert response.status_code == 500
+    records = [record for record in caplog.records if record.name == "main" and record.levelno == logging.ERROR]
+    assert len(records) == 1
+    assert records[0].exc_info is not None
+
+
+def test_phase_timings_include_upload(client, caplog):
+    caplog.set_level(logging.DEBUG, logger="main")
+    pdf_bytes = make_pdf(2).tobytes()
+    redact(client, pdf_bytes, ssn_items(client, pdf_bytes))
+
+    phases = [record.args[0] for record in caplog.records if record.msg == "phase=%s ms=%.2f"]
+    assert phases.count("upload") == 2
+    assert "spool" not in phases
+    assert {"open", "redact", "serialize"} <= set(phases)